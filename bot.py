@@ -11,8 +11,12 @@ import traceback
 from datetime import datetime, timedelta
 import pytz
 import re
+import asyncio
+import hashlib
+import threading
+import math
 from collections import deque
-from typing import Dict, Tuple, Optional, List
+from typing import Dict, Tuple, Optional, List, Union
 
 from telegram import (
     Update, 
@@ -21,7 +25,10 @@ from telegram import (
     InlineKeyboardButton, 
     InlineKeyboardMarkup,
     Message,
-    ChatMember
+    ChatMember,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent
 )
 from telegram.ext import (
     Application,
@@ -30,7 +37,9 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
-    CallbackContext
+    CallbackContext,
+    InlineQueryHandler,
+    ChosenInlineResultHandler
 )
 from telegram.constants import ParseMode, ChatMemberStatus
 from telegram.error import BadRequest
@@ -47,6 +56,62 @@ RATE_LIMIT_PERIOD = 60  # Seconds
 DATA_EXPIRY_DAYS = 30  # Days to keep inactive user data
 MEMBERSHIP_CACHE_EXPIRY = timedelta(hours=1)  # Cache membership status for 1 hour
 
+def env_number(name: str, default: float, cast=float) -> Optional[float]:
+    """Reads a numeric setting from the environment. Returns None if it isn't a number; main() warns about it."""
+    try:
+        return cast(os.environ.get(name, default))
+    except ValueError:
+        return None
+
+# --- Weather Cache Grid Configuration ---
+# Coordinates are snapped to a grid matching the forecast model resolution before fetching,
+# so nearby users share one cache entry. Modes: "km" (fixed grid), "geohash", or "none" (0.01°).
+WEATHER_GRID_MODES = ("km", "geohash", "none")
+WEATHER_GRID_MODE = os.environ.get("WEATHER_GRID_MODE", "km").strip().lower()
+WEATHER_GRID_KM = env_number("WEATHER_GRID_KM", 5.0)  # Grid cell size for "km" mode
+WEATHER_GEOHASH_PRECISION = env_number("WEATHER_GEOHASH_PRECISION", 5, int)  # 1-12; 5 = ~4.9 x 4.9 km cells
+
+# --- Upstream Quota Configuration ---
+# Global request budgets as (max_requests, window_seconds) sliding windows. Open-Meteo counts
+# calls per client across all its APIs, so its three hosts draw from one shared budget.
+OPEN_METEO_HOST = "api.open-meteo.com"
+AQI_HOST = "air-quality-api.open-meteo.com"
+GEOCODING_HOST = "geocoding-api.open-meteo.com"
+NOMINATIM_HOST = "nominatim.openstreetmap.org"
+OPEN_METEO_BUDGET = "open-meteo"
+NOMINATIM_BUDGET = "nominatim"
+UPSTREAM_BUDGET_KEYS = {
+    OPEN_METEO_HOST: OPEN_METEO_BUDGET,
+    AQI_HOST: OPEN_METEO_BUDGET,
+    GEOCODING_HOST: OPEN_METEO_BUDGET,
+    NOMINATIM_HOST: NOMINATIM_BUDGET,
+}
+# (env variable, default limit, window_seconds); defaults stay below the free-tier limits
+UPSTREAM_QUOTA_SETTINGS: Dict[str, List[Tuple[str, int, int]]] = {
+    OPEN_METEO_BUDGET: [
+        ("OPEN_METEO_QUOTA_PER_MINUTE", 500, 60),
+        ("OPEN_METEO_QUOTA_PER_HOUR", 4000, 3600),
+        ("OPEN_METEO_QUOTA_PER_DAY", 8000, 86400),
+    ],
+    NOMINATIM_BUDGET: [
+        ("NOMINATIM_QUOTA_PER_SECOND", 1, 1),  # Nominatim usage policy: max 1 request/second
+        ("NOMINATIM_QUOTA_PER_DAY", 5000, 86400),
+    ],
+}
+UPSTREAM_QUOTAS: Dict[str, List[Tuple[Optional[int], int]]] = {
+    budget: [(env_number(name, default, int), period) for name, default, period in settings]
+    for budget, settings in UPSTREAM_QUOTA_SETTINGS.items()
+}
+UPSTREAM_BUDGET_RESERVE = 0.2  # Below this fraction remaining, only cache-servable requests are admitted
+STALE_CACHE_EXPIRY = timedelta(hours=6)  # Max age of weather data served when the budget is low
+
+# --- Geocoding & Inline Mode Configuration ---
+GEOCODING_RESULT_COUNT = 5  # Results requested per geocoding search
+GEOCODING_CACHE_EXPIRY = timedelta(days=1)
+GEOCODING_MIN_PREFIX = 3  # Shortest inline query answered; shorter queries only match exact names upstream
+INLINE_DEBOUNCE_SECONDS = 0.6  # Wait this long for further keystrokes before geocoding
+INLINE_CACHE_TIME = 60  # Seconds Telegram may cache inline results on its side
+
 # --- Setup Logging with Rotation ---
 log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 log_file = "weather_bot.log"
@@ -70,9 +135,16 @@ logger = logging.getLogger(__name__)
 # --- Cache & State Setup ---
 WEATHER_CACHE: Dict[Tuple[float, float], Tuple[dict, datetime]] = {}
 CACHE_EXPIRY = timedelta(minutes=10)
+weather_cache_origins: Dict[Tuple[float, float], Tuple[float, float]] = {}  # grid_key: legacy 0.01° key that filled it
+weather_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "grid_hits": 0, "stale_hits": 0, "refused": 0}
 user_states: Dict[int, Dict] = {}
 user_rate_limits: Dict[int, deque] = {}
 membership_cache: Dict[int, Tuple[bool, datetime]] = {}  # user_id: (is_member, expiry_time)
+GEOCODING_CACHE: Dict[str, Tuple[List[dict], datetime]] = {}  # normalized query: (results, timestamp)
+inline_query_latest: Dict[int, str] = {}  # user_id: id of the user's most recent inline query
+upstream_calls: Dict[Tuple[str, int], deque] = {}  # (budget, window_seconds): timestamps of requests in that window
+upstream_budget_lock = threading.Lock()  # Budgets are used from the event loop, worker threads and the scheduler
+rendered_reports: Dict[Union[Tuple[int, int], str], Tuple[tuple, str]] = {}  # (chat_id, message_id) or inline_message_id: (report_version, content_hash)
 
 # =============================================================================
 # 0. DATA CLEANUP MODULE
@@ -96,6 +168,7 @@ def cleanup_old_data():
             del user_rate_limits[user_id]
         if user_id in membership_cache:
             del membership_cache[user_id]
+        inline_query_latest.pop(user_id, None)
         logger.info(f"Cleaned up data for inactive user: {user_id}")
 
     expired_cache_keys = []
@@ -106,6 +179,18 @@ def cleanup_old_data():
     for key in expired_cache_keys:
         if key in WEATHER_CACHE:
             del WEATHER_CACHE[key]
+        weather_cache_origins.pop(key, None)
+    
+    expired_geocodes = [key for key, (_, timestamp) in list(GEOCODING_CACHE.items()) if now - timestamp >= GEOCODING_CACHE_EXPIRY]
+    for key in expired_geocodes:
+        if key in GEOCODING_CACHE:
+            del GEOCODING_CACHE[key]
+    
+    # Clean rendered report versions whose weather data has expired
+    expired_reports = [key for key, (version, _) in list(rendered_reports.items()) if now - version[1] >= CACHE_EXPIRY]
+    for key in expired_reports:
+        if key in rendered_reports:
+            del rendered_reports[key]
     
     # Clean expired membership cache
     expired_members = [user_id for user_id, (_, expiry) in membership_cache.items() if now > expiry]
@@ -114,11 +199,20 @@ def cleanup_old_data():
             del membership_cache[user_id]
         logger.info(f"Cleaned expired membership cache for user: {user_id}")
     
+    stats = get_weather_cache_stats()
+    logger.info(f"Weather cache: {stats['hits']} hits, {stats['misses']} misses, "
+                f"hit rate {stats['hit_rate']:.1%} ({stats['grid_hits']} hits gained from {WEATHER_GRID_MODE} grid snapping).")
+    
     if inactive_users or expired_cache_keys or expired_members:
         logger.info(f"Cleanup complete. Removed {len(inactive_users)} users, {len(expired_cache_keys)} cache entries, and {len(expired_members)} membership entries.")
     else:
         logger.info("Periodic cleanup ran. No old data to remove.")
 
+def log_upstream_budget():
+    """Periodically logs upstream quota usage for monitoring."""
+    for budget, windows in get_upstream_budget_usage().items():
+        logger.info(f"Upstream budget for {budget}: {format_budget_usage(windows)}")
+
 def update_user_activity(user_id: int):
     """Updates the last_seen timestamp for a user."""
     if user_id not in user_states:
@@ -194,7 +288,10 @@ async def reply_with_join_message(update: Update):
         "2. After joining, tap '✅ I've Joined' to verify\n"
     )
     
-    if update.callback_query:
+    if update.callback_query and not update.callback_query.message:
+        # Button on a message sent via inline mode: there is no chat to reply in
+        await update.callback_query.answer("🔒 Please join our main channel to use this bot.", show_alert=True)
+    elif update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.message.reply_text(text, reply_markup=keyboard)
     elif update.message:
@@ -204,6 +301,9 @@ async def reply_with_join_message(update: Update):
 # 2. ENHANCED API INTERACTION MODULE
 # =============================================================================
 
+class UpstreamBudgetExhausted(Exception):
+    """Raised when a lookup can't be served because an upstream host's request budget is used up"""
+
 def rate_limit_user(user_id: int) -> bool:
     """Enforce rate limiting for users"""
     now = datetime.now()
@@ -219,19 +319,119 @@ def rate_limit_user(user_id: int) -> bool:
     user_rate_limits[user_id].append(now)
     return True
 
-def get_location_from_name(city_name: str) -> Optional[dict]:
-    """Geocodes a city name with enhanced error handling"""
+def _get_upstream_window_usage(budget: str, now: datetime) -> List[Tuple[int, int, int]]:
+    """
+    Prunes each quota window of a budget from the left and returns (limit, window_seconds, used) per window.
+    Callers must hold upstream_budget_lock.
+    """
+    usage = []
+    for limit, period in UPSTREAM_QUOTAS.get(budget, []):
+        if (budget, period) not in upstream_calls:
+            upstream_calls[(budget, period)] = deque()
+        calls = upstream_calls[(budget, period)]
+        while calls and (now - calls[0]).total_seconds() > period:
+            calls.popleft()
+        usage.append((limit, period, len(calls)))
+    return usage
+
+def _remaining_budget(budget: str, now: datetime) -> float:
+    """Fraction of the tightest quota window still available. Callers must hold upstream_budget_lock."""
+    remaining = 1.0
+    for limit, _, used in _get_upstream_window_usage(budget, now):
+        remaining = min(remaining, max(0.0, (limit - used) / limit))
+    return remaining
+
+def get_upstream_budget(host: str) -> float:
+    """Returns the fraction of the tightest quota window still available for a host's budget (1.0 = unused)"""
+    with upstream_budget_lock:
+        return _remaining_budget(UPSTREAM_BUDGET_KEYS[host], datetime.now())
+
+def is_upstream_budget_low(host: str) -> bool:
+    """Checks whether a host's budget has dropped into the reserve"""
+    return get_upstream_budget(host) < UPSTREAM_BUDGET_RESERVE
+
+def acquire_upstream_budget(host: str, essential: bool = True) -> bool:
+    """
+    Admission control for upstream API calls. Records the call and returns True if admitted.
+    Non-essential calls are refused once the budget is low; essential calls only when it is exhausted.
+    """
+    budget_key = UPSTREAM_BUDGET_KEYS[host]
+    now = datetime.now()
+    with upstream_budget_lock:
+        budget = _remaining_budget(budget_key, now)
+        admitted = budget > 0 and (essential or budget >= UPSTREAM_BUDGET_RESERVE)
+        if admitted:
+            for _, period in UPSTREAM_QUOTAS.get(budget_key, []):
+                upstream_calls[(budget_key, period)].append(now)
+    if not admitted:
+        logger.warning(f"Upstream budget for {host} {'exhausted' if budget <= 0 else 'low'}, request refused")
+    return admitted
+
+def get_upstream_budget_usage() -> Dict[str, List[dict]]:
+    """Returns current quota usage for every upstream budget, for monitoring"""
+    now = datetime.now()
+    usage = {}
+    with upstream_budget_lock:
+        for budget in UPSTREAM_QUOTAS:
+            usage[budget] = [
+                {"window_seconds": period, "used": used, "limit": limit}
+                for limit, period, used in _get_upstream_window_usage(budget, now)
+            ]
+    return usage
+
+def format_budget_usage(windows: List[dict]) -> str:
+    """Formats one budget's window usage as 'used/limit per Ns, ...'"""
+    return ", ".join(f"{w['used']}/{w['limit']} per {w['window_seconds']}s" for w in windows)
+
+def get_cached_locations(city_name: str, allow_prefix: bool = False) -> Optional[List[dict]]:
+    """
+    Returns geocoding results for a name from cache only, without any upstream call.
+    With allow_prefix, falls back to a cached shorter prefix whose result list was complete, filtered
+    by name. Open-Meteo matches fuzzily and on alternative names, so this is only good enough for
+    inline suggestions; an empty filtered list counts as a miss.
+    """
+    query = city_name.strip().lower()
+    now = datetime.now()
+    if query in GEOCODING_CACHE:
+        results, timestamp = GEOCODING_CACHE[query]
+        if now - timestamp < GEOCODING_CACHE_EXPIRY:
+            return results
+    if not allow_prefix:
+        return None
+    for length in range(len(query) - 1, GEOCODING_MIN_PREFIX - 1, -1):
+        prefix = query[:length]
+        if prefix not in GEOCODING_CACHE:
+            continue
+        results, timestamp = GEOCODING_CACHE[prefix]
+        if now - timestamp < GEOCODING_CACHE_EXPIRY and len(results) < GEOCODING_RESULT_COUNT:
+            matches = [r for r in results if r.get("name", "").lower().startswith(query)]
+            if matches:
+                return matches
+    return None
+
+def search_locations(city_name: str) -> Optional[List[dict]]:
+    """
+    Geocodes a city name into a list of candidate locations, using the geocoding cache.
+    Raises UpstreamBudgetExhausted if the lookup needs an upstream call and the budget is used up.
+    """
     try:
         if re.match(r'^[\U0001F300-\U0001F6FF\s]+$', city_name):
             return None
-        url = f"https://geocoding-api.open-meteo.com/v1/search?name={city_name}&count=5&language=en&format=json"
-        response = requests.get(url, timeout=15)
+        cached = get_cached_locations(city_name)
+        if cached is not None:
+            return cached
+        if not acquire_upstream_budget(GEOCODING_HOST):
+            raise UpstreamBudgetExhausted(GEOCODING_HOST)
+        params = {"name": city_name.strip(), "count": GEOCODING_RESULT_COUNT, "language": "en", "format": "json"}
+        url = f"https://{GEOCODING_HOST}/v1/search"
+        response = requests.get(url, params=params, timeout=15)
         response.raise_for_status()
         data = response.json()
-        if "results" in data and data["results"]:
-            return data["results"][0]
-        logger.warning(f"No results found for city: {city_name}")
-        return None
+        results = data.get("results") or []
+        GEOCODING_CACHE[city_name.strip().lower()] = (results, datetime.now())
+        return results
+    except UpstreamBudgetExhausted:
+        raise
     except requests.exceptions.RequestException as e:
         logger.error(f"Geocoding API request failed for '{city_name}': {str(e)}")
         return None
@@ -239,11 +439,23 @@ def get_location_from_name(city_name: str) -> Optional[dict]:
         logger.error(f"Unexpected error in geocoding: {str(e)}")
         return None
 
+def get_location_from_name(city_name: str) -> Optional[dict]:
+    """Geocodes a city name with enhanced error handling"""
+    results = search_locations(city_name)
+    if results:
+        return results[0]
+    if results is not None:
+        logger.warning(f"No results found for city: {city_name}")
+    return None
+
 def get_location_from_coords(lat: float, lon: float) -> Optional[dict]:
     """Reverse geocodes coordinates with enhanced error handling"""
     try:
+        # Place names are cosmetic: skip reverse geocoding once the budget runs low
+        if not acquire_upstream_budget(NOMINATIM_HOST, essential=False):
+            return {"name": "Your Current Location"}
         headers = {'User-Agent': 'TelegramWeatherBot/2.0'}
-        url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=10"
+        url = f"https://{NOMINATIM_HOST}/reverse?format=json&lat={lat}&lon={lon}&zoom=10"
         response = requests.get(url, headers=headers, timeout=15)
         response.raise_for_status()
         data = response.json()
@@ -262,17 +474,75 @@ def get_location_from_coords(lat: float, lon: float) -> Optional[dict]:
         logger.error(f"Unexpected error in reverse geocoding: {str(e)}")
         return {"name": "Your Current Location"}
 
+def geohash_cell_center(latitude: float, longitude: float, precision: int) -> Tuple[float, float]:
+    """Returns the center of the geohash cell of the given precision containing a point"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for _ in range(precision * 5):  # 5 bits per base32 character
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+    return ((lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2)
+
+def snap_to_weather_grid(latitude: float, longitude: float) -> Tuple[float, float]:
+    """
+    Snaps coordinates to the configured weather grid.
+    The snapped point is used both for the API request and as the WEATHER_CACHE key.
+    """
+    if WEATHER_GRID_MODE == "geohash":
+        lat, lon = geohash_cell_center(latitude, longitude, WEATHER_GEOHASH_PRECISION)
+    elif WEATHER_GRID_MODE == "km":
+        lat_step = WEATHER_GRID_KM / 111.32  # km per degree of latitude
+        lat = (math.floor(latitude / lat_step) + 0.5) * lat_step
+        lat = max(-90.0, min(90.0, lat))
+        # Longitude cells widen towards the poles; size them at the snapped latitude
+        lon_step = min(360.0, lat_step / max(math.cos(math.radians(lat)), 0.01))
+        lon = (math.floor((longitude + 180.0) / lon_step) + 0.5) * lon_step - 180.0
+        lon = max(-180.0, min(180.0, lon))
+    else:
+        return (round(latitude, 2), round(longitude, 2))
+    return (round(lat, 4), round(lon, 4))
+
+def get_weather_cache_stats() -> dict:
+    """Returns weather cache hit/miss counters and the hit rate (stale serves and refusals are counted apart)"""
+    lookups = weather_cache_stats["hits"] + weather_cache_stats["misses"]
+    hit_rate = weather_cache_stats["hits"] / lookups if lookups else 0.0
+    return {**weather_cache_stats, "hit_rate": hit_rate, "entries": len(WEATHER_CACHE)}
+
 def get_weather_and_forecast(latitude: float, longitude: float) -> Optional[dict]:
     """Fetches weather data with caching and enhanced error handling"""
-    cache_key = (round(latitude, 2), round(longitude, 2))
+    cache_key = snap_to_weather_grid(latitude, longitude)
     now = datetime.now()
     
+    legacy_key = (round(latitude, 2), round(longitude, 2))
+    
     if cache_key in WEATHER_CACHE:
         cached_data, timestamp = WEATHER_CACHE[cache_key]
         if now - timestamp < CACHE_EXPIRY:
+            weather_cache_stats["hits"] += 1
+            if weather_cache_origins.get(cache_key) != legacy_key:
+                weather_cache_stats["grid_hits"] += 1
             logger.info(f"Using cached weather data for {cache_key}")
             return cached_data
     
+    # Low budget: only admit requests that can be served from cache, even if stale
+    if not acquire_upstream_budget(OPEN_METEO_HOST, essential=False):
+        if cache_key in WEATHER_CACHE:
+            cached_data, timestamp = WEATHER_CACHE[cache_key]
+            if now - timestamp < STALE_CACHE_EXPIRY:
+                weather_cache_stats["stale_hits"] += 1
+                logger.info(f"Upstream budget low, serving stale weather data for {cache_key}")
+                return cached_data
+        weather_cache_stats["refused"] += 1
+        return None
+    weather_cache_stats["misses"] += 1
+    
+    # Fetch for the grid point so the cached data matches its key for every user in the cell
+    latitude, longitude = cache_key
     try:
         params = {
             "latitude": latitude, "longitude": longitude,
@@ -281,29 +551,32 @@ def get_weather_and_forecast(latitude: float, longitude: float) -> Optional[dict
             "daily": "weather_code,temperature_2m_max,temperature_2m_min,sunrise,sunset,uv_index_max,precipitation_sum,precipitation_probability_max,wind_speed_10m_max",
             "timezone": "auto"
         }
-        url = "https://api.open-meteo.com/v1/forecast"
+        url = f"https://{OPEN_METEO_HOST}/v1/forecast"
         response = requests.get(url, params=params, timeout=15)
         response.raise_for_status()
         data = response.json()
         
+        # Air quality is optional: skip it rather than eat into the reserve
         try:
-            aqi_params = {"latitude": latitude, "longitude": longitude, "hourly": "european_aqi"}
-            aqi_url = "https://air-quality-api.open-meteo.com/v1/air-quality"
-            aqi_response = requests.get(aqi_url, params=aqi_params, timeout=10)
-            if aqi_response.status_code == 200:
-                aqi_data = aqi_response.json()
-                if "hourly" in aqi_data and "european_aqi" in aqi_data["hourly"]:
-                    now_utc = datetime.now(pytz.utc)
-                    current_time_str = now_utc.strftime('%Y-%m-%dT%H:00')
-                    try:
-                        time_index = aqi_data['hourly']['time'].index(current_time_str)
-                        data["current"]["european_aqi"] = aqi_data["hourly"]["european_aqi"][time_index]
-                    except (ValueError, IndexError):
-                        data["current"]["european_aqi"] = aqi_data["hourly"]["european_aqi"][0]
+            if acquire_upstream_budget(AQI_HOST, essential=False):
+                aqi_params = {"latitude": latitude, "longitude": longitude, "hourly": "european_aqi"}
+                aqi_url = f"https://{AQI_HOST}/v1/air-quality"
+                aqi_response = requests.get(aqi_url, params=aqi_params, timeout=10)
+                if aqi_response.status_code == 200:
+                    aqi_data = aqi_response.json()
+                    if "hourly" in aqi_data and "european_aqi" in aqi_data["hourly"]:
+                        now_utc = datetime.now(pytz.utc)
+                        current_time_str = now_utc.strftime('%Y-%m-%dT%H:00')
+                        try:
+                            time_index = aqi_data['hourly']['time'].index(current_time_str)
+                            data["current"]["european_aqi"] = aqi_data["hourly"]["european_aqi"][time_index]
+                        except (ValueError, IndexError):
+                            data["current"]["european_aqi"] = aqi_data["hourly"]["european_aqi"][0]
         except Exception as e:
             logger.warning(f"Couldn't fetch air quality data: {str(e)}")
         
         WEATHER_CACHE[cache_key] = (data, now)
+        weather_cache_origins[cache_key] = legacy_key
         return data
     except requests.exceptions.RequestException as e:
         logger.error(f"Weather API request failed: {str(e)}")
@@ -312,6 +585,57 @@ def get_weather_and_forecast(latitude: float, longitude: float) -> Optional[dict
         logger.error(f"Unexpected error in weather API: {str(e)}")
         return None
 
+def get_stale_weather_timestamp(latitude: float, longitude: float) -> Optional[datetime]:
+    """Returns when the cached data for a location was fetched if it is past CACHE_EXPIRY, else None"""
+    cache_key = snap_to_weather_grid(latitude, longitude)
+    if cache_key in WEATHER_CACHE:
+        _, timestamp = WEATHER_CACHE[cache_key]
+        if datetime.now() - timestamp >= CACHE_EXPIRY:
+            return timestamp
+    return None
+
+def get_cached_weather(latitude: float, longitude: float) -> Optional[dict]:
+    """Returns fresh cached weather data for a location without fetching"""
+    cache_key = snap_to_weather_grid(latitude, longitude)
+    if cache_key in WEATHER_CACHE:
+        cached_data, timestamp = WEATHER_CACHE[cache_key]
+        if datetime.now() - timestamp < CACHE_EXPIRY:
+            return cached_data
+    return None
+
+def get_report_version(latitude: float, longitude: float, display_name: str) -> Optional[tuple]:
+    """
+    Returns the version of the report that would be rendered right now, without fetching.
+    A report only changes when its cached data, the local hour or the display name changes.
+    Returns None if there is no fresh cache entry for the location.
+    """
+    cache_key = snap_to_weather_grid(latitude, longitude)
+    if cache_key not in WEATHER_CACHE:
+        return None
+    cached_data, timestamp = WEATHER_CACHE[cache_key]
+    if datetime.now() - timestamp >= CACHE_EXPIRY:
+        return None
+    try:
+        local_tz = pytz.timezone(cached_data.get('timezone', 'UTC'))
+    except pytz.UnknownTimeZoneError:
+        local_tz = pytz.utc
+    current_hour = datetime.now(local_tz).strftime('%Y-%m-%dT%H')
+    return (cache_key, timestamp, current_hour, display_name)
+
+def is_report_current(report_key: Union[Tuple[int, int], str], latitude: float, longitude: float, display_name: str) -> bool:
+    """
+    Checks whether a rendered message already shows the latest report for its location.
+    report_key is (chat_id, message_id), or the inline_message_id for messages sent via inline mode.
+    """
+    rendered = rendered_reports.get(report_key)
+    if not rendered:
+        return False
+    return rendered[0] == get_report_version(latitude, longitude, display_name)
+
+def hash_report(text: str, keyboard: InlineKeyboardMarkup) -> str:
+    """Content hash of a rendered report, used to skip edits that wouldn't change anything"""
+    return hashlib.sha1(f"{text}\x00{keyboard.to_json()}".encode("utf-8")).hexdigest()
+
 # =============================================================================
 # 3. ENHANCED DATA FORMATTING MODULE
 # =============================================================================
@@ -348,7 +672,15 @@ def get_aqi_description(aqi: int) -> str:
     if aqi <= 100: return f"{aqi} (Very Poor)"
     return f"{aqi} (Extremely Poor)"
 
-def format_full_weather_report(weather_data: dict, location_name: str) -> str:
+def format_stale_notice(weather_data: dict, as_of: datetime) -> str:
+    """Warning line for reports served from stale cache while the upstream budget is low."""
+    try:
+        local_tz = pytz.timezone(weather_data.get('timezone', 'UTC'))
+    except pytz.UnknownTimeZoneError:
+        local_tz = pytz.utc
+    return f"⚠️ Weather data as of {as_of.astimezone(local_tz).strftime('%H:%M')} (service busy, showing last update)"
+
+def format_full_weather_report(weather_data: dict, location_name: str, as_of: Optional[datetime] = None) -> str:
     if not weather_data:
         return "❌ Sorry, weather service is currently unavailable. Please try again later."
     try:
@@ -359,6 +691,8 @@ def format_full_weather_report(weather_data: dict, location_name: str) -> str:
         local_tz = pytz.timezone(timezone_str)
         
         report = [f"📍 *{html.escape(location_name)}*"]
+        if as_of:
+            report.append(format_stale_notice(weather_data, as_of))
         emoji, weather_desc = get_weather_description(current.get('weather_code'))
         report.append("\n🌤️ *Current Conditions*")
         report.append(f"{emoji} {weather_desc}")
@@ -402,6 +736,26 @@ def format_full_weather_report(weather_data: dict, location_name: str) -> str:
         logger.error(f"Critical error formatting weather: {str(e)}", exc_info=True)
         return "❌ An error occurred while processing weather data."
 
+def format_compact_weather_card(weather_data: Optional[dict], location_name: str, as_of: Optional[datetime] = None) -> str:
+    """Short weather card used for inline mode results."""
+    if not weather_data:
+        return f"📍 *{html.escape(location_name)}*\n⏳ Loading forecast... Tap 🔄 Refresh if it doesn't appear."
+    try:
+        current = weather_data.get('current', {})
+        daily = weather_data.get('daily', {})
+        emoji, weather_desc = get_weather_description(current.get('weather_code'))
+        return "\n".join(filter(None, [
+            f"📍 *{html.escape(location_name)}*",
+            format_stale_notice(weather_data, as_of) if as_of else None,
+            f"{emoji} {weather_desc}, {current.get('temperature_2m', 'N/A')}°C (Feels like: {current.get('apparent_temperature', 'N/A')}°C)",
+            f"🌡️ High/Low: {daily.get('temperature_2m_max', [None])[0]}°C / {daily.get('temperature_2m_min', [None])[0]}°C",
+            f"💧 Precip: {daily.get('precipitation_probability_max', [None])[0]}% chance",
+            f"💨 Wind: {current.get('wind_speed_10m', 'N/A')} km/h",
+        ]))
+    except Exception as e:
+        logger.error(f"Error formatting weather card: {str(e)}", exc_info=True)
+        return "❌ An error occurred while processing weather data."
+
 # =============================================================================
 # 4. ENHANCED BOT HANDLERS & MAIN LOGIC
 # =============================================================================
@@ -449,7 +803,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "   - /current - Get weather for saved location\n\n"
         "3. *Membership Verification*\n"
         "   - /verify - Re-check channel membership\n\n"
-        "4. *Other Commands*\n"
+        "4. *Inline Mode*\n"
+        "   - Type the bot's username and a city in any chat\n\n"
+        "5. *Other Commands*\n"
         "   - /start - Welcome message\n"
         "   - /help - This guide\n"
         "   - /feedback `your message` - Send feedback"
@@ -520,6 +876,21 @@ async def current_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         await update.message.reply_text("You haven't set a default location. Please share a location or use /setlocation first.")
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Developer-only command showing upstream budget usage and weather cache stats."""
+    if not DEVELOPER_CHAT_ID or update.effective_user.id != int(DEVELOPER_CHAT_ID):
+        return
+    
+    lines = ["📊 *Upstream Budget*"]
+    for budget, windows in get_upstream_budget_usage().items():
+        lines.append(f"• `{budget}`: {format_budget_usage(windows)}")
+    stats = get_weather_cache_stats()
+    lines.append("\n🗄️ *Weather Cache*")
+    lines.append(f"• {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+    lines.append(f"• {stats['grid_hits']} hits gained from `{WEATHER_GRID_MODE}` grid snapping")
+    lines.append(f"• {stats['stale_hits']} stale serves, {stats['refused']} refused (low upstream budget)")
+    await update.message.reply_markdown("\n".join(lines))
+
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -558,7 +929,11 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     sent_message = await update.message.reply_text(f"🔍 Searching for *{text}*...", parse_mode=ParseMode.MARKDOWN)
-    location_data = get_location_from_name(text)
+    try:
+        location_data = get_location_from_name(text)
+    except UpstreamBudgetExhausted:
+        await sent_message.edit_text("⏳ The bot is very busy right now. Please try again in a few minutes.")
+        return
     
     if location_data:
         full_display_name = ", ".join(filter(None, [location_data.get("name"), location_data.get("admin1"), location_data.get("country")]))
@@ -591,16 +966,27 @@ async def process_location_request(update: Update, context: ContextTypes.DEFAULT
         weather_data = get_weather_and_forecast(latitude, longitude)
         if not weather_data:
             error_msg = "❌ Weather service is currently unavailable. Please try again later."
+            if is_upstream_budget_low(OPEN_METEO_HOST):
+                error_msg = "⏳ The bot is very busy right now. Please try again in a few minutes."
             if message_to_edit: await message_to_edit.edit_text(error_msg)
             else: await safe_reply(update, error_msg)
             return
         
-        weather_message = format_full_weather_report(weather_data, display_name)
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Refresh", callback_data=f"refresh_{latitude}_{longitude}")]])
+        weather_message = format_full_weather_report(weather_data, display_name, as_of=get_stale_weather_timestamp(latitude, longitude))
+        keyboard = build_refresh_keyboard(latitude, longitude)
         
         if message_to_edit:
+            report_key = (message_to_edit.chat_id, message_to_edit.message_id)
+            content_hash = hash_report(weather_message, keyboard)
+            rendered = rendered_reports.get(report_key)
+            report_version = get_report_version(latitude, longitude, display_name)
             try:
-                await message_to_edit.edit_text(weather_message, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard, disable_web_page_preview=True)
+                if rendered and rendered[1] == content_hash:
+                    logger.info("Content is the same, no need to edit.")
+                else:
+                    await message_to_edit.edit_text(weather_message, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard, disable_web_page_preview=True)
+                if report_version:
+                    rendered_reports[report_key] = (report_version, content_hash)
             except BadRequest as e:
                 if "Message is not modified" in str(e):
                     logger.info("Content is the same, no need to edit.")
@@ -643,10 +1029,149 @@ async def handle_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if round(saved_lat, 4) == round(latitude, 4) and round(saved_lon, 4) == round(longitude, 4):
             display_name = saved_name
     
+    if query.inline_message_id:
+        if is_report_current(query.inline_message_id, latitude, longitude, display_name):
+            await query.answer("Weather is already up-to-date.")
+            return
+        await query.answer("Refreshing...")
+        await update_inline_card(context, query.inline_message_id, latitude, longitude, display_name)
+        return
+    
+    # Nothing changed since this message was rendered: skip the fetch and the edit
+    if is_report_current((query.message.chat_id, query.message.message_id), latitude, longitude, display_name):
+        await query.answer("Weather is already up-to-date.")
+        return
+    
     await query.answer("Refreshing...")
     await process_location_request(update, context, latitude, longitude, display_name, message_to_edit=query.message)
 
 
+def build_refresh_keyboard(latitude: float, longitude: float) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Refresh", callback_data=f"refresh_{latitude}_{longitude}")]])
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Answers inline queries (@bot paris) with compact weather cards.
+    Only cached weather is shown here; keystrokes are debounced, superseded queries dropped and
+    geocoding calls count against the user's rate limit, so a lookup costs at most one geocoding
+    call and the forecast is fetched on selection. Cache-served answers are not rate limited.
+    """
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    text = inline_query.query.strip()
+    inline_query_latest[user_id] = inline_query.id
+    if len(text) < GEOCODING_MIN_PREFIX:
+        # Answer right away so the client stops its spinner; results change with the next keystroke
+        del inline_query_latest[user_id]
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
+    
+    if not await check_channel_membership(update, context):
+        button = InlineQueryResultsButton(text="🔒 Join our channel to use this bot", start_parameter="join")
+        await inline_query.answer([], button=button, cache_time=0, is_personal=True)
+        return
+    update_user_activity(user_id)
+    
+    locations = get_cached_locations(text, allow_prefix=True)
+    if locations is None:
+        await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+        if inline_query_latest.get(user_id) != inline_query.id:
+            return  # Superseded by a later keystroke
+        if not rate_limit_user(user_id):
+            del inline_query_latest[user_id]
+            button = InlineQueryResultsButton(text="⏳ Too many searches, please wait a moment", start_parameter="start")
+            await inline_query.answer([], button=button, cache_time=0, is_personal=True)
+            return
+        try:
+            # Run the blocking geocoding request off the event loop so other updates keep flowing
+            locations = await asyncio.to_thread(search_locations, text) or []
+        except UpstreamBudgetExhausted:
+            locations = []
+    if inline_query_latest.get(user_id) == inline_query.id:
+        del inline_query_latest[user_id]
+    
+    results = []
+    for location in locations:
+        latitude, longitude = location["latitude"], location["longitude"]
+        display_name = ", ".join(filter(None, [location.get("name"), location.get("admin1"), location.get("country")]))
+        weather_data = get_cached_weather(latitude, longitude)
+        if weather_data:
+            emoji, weather_desc = get_weather_description(weather_data.get('current', {}).get('weather_code'))
+            description = f"{emoji} {weather_desc}, {weather_data.get('current', {}).get('temperature_2m', 'N/A')}°C"
+        else:
+            description = "Tap to get the forecast"
+        results.append(InlineQueryResultArticle(
+            # "p_" marks a placeholder card that must be filled in once chosen
+            id=f"{latitude}_{longitude}" if weather_data else f"p_{latitude}_{longitude}",
+            title=display_name,
+            description=description,
+            input_message_content=InputTextMessageContent(format_compact_weather_card(weather_data, display_name), parse_mode=ParseMode.MARKDOWN),
+            reply_markup=build_refresh_keyboard(latitude, longitude),
+        ))
+    try:
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+    except BadRequest as e:
+        # Telegram rejects answers to queries that expired while we were debouncing or fetching
+        logger.info(f"Could not answer inline query '{text}': {e}")
+
+async def handle_chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Fills in the forecast once the user picks an inline result.
+    Requires inline feedback to be enabled for the bot via @BotFather (/setinlinefeedback).
+    """
+    chosen = update.chosen_inline_result
+    user_id = chosen.from_user.id
+    update_user_activity(user_id)
+    if not chosen.inline_message_id:
+        return
+    
+    is_placeholder = chosen.result_id.startswith("p_")
+    try:
+        lat_str, lon_str = chosen.result_id.removeprefix("p_").split('_')
+        latitude, longitude = float(lat_str), float(lon_str)
+    except ValueError as e:
+        logger.error(f"Could not parse inline result id: {chosen.result_id}, error: {e}")
+        return
+    
+    display_name = "Selected Location"
+    for location in get_cached_locations(chosen.query, allow_prefix=True) or []:
+        if location["latitude"] == latitude and location["longitude"] == longitude:
+            display_name = ", ".join(filter(None, [location.get("name"), location.get("admin1"), location.get("country")]))
+            break
+    user_states[user_id]["last_location"] = (latitude, longitude, display_name)
+    
+    if not is_placeholder:
+        return  # The card was already rendered from cache
+    await update_inline_card(context, chosen.inline_message_id, latitude, longitude, display_name)
+
+async def update_inline_card(context: ContextTypes.DEFAULT_TYPE, inline_message_id: str, latitude: float, longitude: float, display_name: str) -> None:
+    """Fetches weather and re-renders a compact card sent via inline mode."""
+    # Run the blocking weather requests off the event loop so other updates keep flowing
+    weather_data = await asyncio.to_thread(get_weather_and_forecast, latitude, longitude)
+    if weather_data:
+        text = format_compact_weather_card(weather_data, display_name, as_of=get_stale_weather_timestamp(latitude, longitude))
+    elif is_upstream_budget_low(OPEN_METEO_HOST):
+        text = f"📍 *{html.escape(display_name)}*\n⏳ The bot is very busy right now. Please try again in a few minutes."
+    else:
+        text = f"📍 *{html.escape(display_name)}*\n❌ Weather service is currently unavailable. Please try again later."
+    keyboard = build_refresh_keyboard(latitude, longitude)
+    content_hash = hash_report(text, keyboard)
+    rendered = rendered_reports.get(inline_message_id)
+    report_version = get_report_version(latitude, longitude, display_name)
+    try:
+        if rendered and rendered[1] == content_hash:
+            logger.info("Content is the same, no need to edit.")
+        else:
+            await context.bot.edit_message_text(text, inline_message_id=inline_message_id, parse_mode=ParseMode.MARKDOWN,
+                                                reply_markup=keyboard)
+        if report_version:
+            rendered_reports[inline_message_id] = (report_version, content_hash)
+    except BadRequest as e:
+        if "Message is not modified" in str(e):
+            logger.info("Content is the same, no need to edit.")
+        else:
+            raise e
+
 async def safe_reply(update: Update, text: str) -> None:
     try:
         target = update.callback_query.message if update.callback_query else update.message
@@ -679,10 +1204,35 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     if isinstance(update, Update) and update.effective_message:
         await safe_reply(update, "⚠️ An unexpected error occurred. Our team has been notified.")
 
+def validate_weather_grid_config() -> None:
+    """Warns about invalid weather grid settings and falls back to 0.01° rounding."""
+    global WEATHER_GRID_MODE
+    problem = None
+    if WEATHER_GRID_MODE not in WEATHER_GRID_MODES:
+        problem = f"Unknown WEATHER_GRID_MODE '{WEATHER_GRID_MODE}' (expected one of {', '.join(WEATHER_GRID_MODES)})"
+    elif WEATHER_GRID_MODE == "km" and (WEATHER_GRID_KM is None or WEATHER_GRID_KM <= 0):
+        problem = f"Invalid WEATHER_GRID_KM '{os.environ.get('WEATHER_GRID_KM')}' (expected a positive number)"
+    elif WEATHER_GRID_MODE == "geohash" and (WEATHER_GEOHASH_PRECISION is None or not 1 <= WEATHER_GEOHASH_PRECISION <= 12):
+        problem = f"Invalid WEATHER_GEOHASH_PRECISION '{os.environ.get('WEATHER_GEOHASH_PRECISION')}' (expected an integer from 1 to 12)"
+    if problem:
+        logger.warning(f"{problem}, falling back to 0.01° rounding.")
+        WEATHER_GRID_MODE = "none"
+
+def validate_upstream_quotas() -> None:
+    """Warns about invalid upstream quota settings and falls back to the default limits."""
+    for budget, settings in UPSTREAM_QUOTA_SETTINGS.items():
+        for i, (name, default, period) in enumerate(settings):
+            limit = UPSTREAM_QUOTAS[budget][i][0]
+            if limit is None or limit <= 0:
+                logger.warning(f"Invalid {name} '{os.environ.get(name)}' (expected a positive integer), falling back to {default}.")
+                UPSTREAM_QUOTAS[budget][i] = (default, period)
+
 def main() -> None:
     if not TELEGRAM_TOKEN or TELEGRAM_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN":
         logger.critical("FATAL: TELEGRAM_TOKEN is not set!")
         return
+    validate_weather_grid_config()
+    validate_upstream_quotas()
     
     application = Application.builder().token(TELEGRAM_TOKEN).build()
     
@@ -694,6 +1244,7 @@ def main() -> None:
     application.add_handler(CommandHandler("mylocation", my_location_command))
     application.add_handler(CommandHandler("current", current_command))
     application.add_handler(CommandHandler("verify", verify_membership_command))  # New command
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_handler(MessageHandler(filters.LOCATION, handle_location_message))
     
@@ -701,9 +1252,14 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(handle_button, pattern="^(help_guide|verify_membership)$"))
     application.add_handler(CallbackQueryHandler(handle_refresh, pattern="^refresh_"))
     
+    # Inline mode: block=False so a debouncing query doesn't hold up other updates
+    application.add_handler(InlineQueryHandler(handle_inline_query, block=False))
+    application.add_handler(ChosenInlineResultHandler(handle_chosen_inline_result))
+    
     # --- Set up and start the background cleanup task ---
     scheduler = BackgroundScheduler(timezone=str(pytz.utc))
     scheduler.add_job(cleanup_old_data, 'interval', days=1)
+    scheduler.add_job(log_upstream_budget, 'interval', minutes=10)
     scheduler.start()
     
     logger.info("Starting bot with enhanced membership verification...")